@@ -2,23 +2,35 @@
 This module provides a script for uploading files from a local directory to an
 Amazon S3 bucket. The script performs the following tasks:
 
-1. Confirms the S3 bucket name and prefix, as well as the source directory.
-2. Uploads files from the source directory to the S3 bucket, retrying on failure
-   up to a maximum number of attempts.
+1. Confirms the S3 bucket name and prefix, as well as the source directory,
+   unless run with --yes.
+2. Uploads files from the source directory to the S3 bucket concurrently,
+   retrying on failure up to a maximum number of attempts.
 3. Logs the details of each file upload (successful or failed) to a CSV log file.
 4. Displays a summary of the file upload process, including the number of
    successful and failed uploads, and the location of the log file.
 
-The script can be run as a standalone Python script. It requires the `boto3`
-library to interact with the AWS S3 service.
+The script can be run as a standalone Python script. The predefined folder,
+bucket and prefix can be overridden with --folder, --bucket and --prefix. It
+requires the `boto3` library to interact with the AWS S3 service.
 """
 
 import os
+import argparse
 import csv
-import time
+import hashlib
+import io
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime
+from functools import partial
 import sys
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Predefined folder and S3 bucket/prefix
 if os.name == 'nt':  # Windows
@@ -27,210 +39,522 @@ else:  # macOS/Linux
     FOLDER_PATH = os.path.expanduser("~/Documents/s3_upload")
 S3_BUCKET_NAME = "my_bucket"
 S3_PREFIX = "s3_receive"
-MAX_RETRIES = 3  # Maximum number of retries for file uploads
+MAX_RETRIES = 3  # Maximum number of attempts for each S3 request
+# Small files are sent in a single request each, so many of them can be in
+# flight at once; large files already upload their parts concurrently. The
+# two pools together fill the connection pool (4 x 10 parts + 24 = 64).
+MAX_SMALL_FILE_WORKERS = 24  # Files below the multipart threshold
+MAX_LARGE_FILE_WORKERS = 4  # Files uploaded in parts
+MAX_POOL_CONNECTIONS = 64  # Size of the S3 client's HTTP connection pool
+# Upper bound on the file data buffered in memory by in-flight uploads. The
+# default worker pools stay below it; it guards against larger pool or
+# TransferConfig settings.
+MAX_INFLIGHT_BYTES = 512 * 1024 * 1024
+# When enabled (or run with --bundle), files below the bundle threshold are
+# uploaded together as a single gzipped tar archive instead of one object per
+# file
+BUNDLE_SMALL_FILES = False
+BUNDLE_THRESHOLD_BYTES = 1 << 20
+# Multipart settings used for every upload; files above the threshold are
+# split into parts that are uploaded concurrently
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=10,
+                                 use_threads=True)
+# Settings for the S3 client shared by every upload. Retries use botocore's
+# adaptive mode, which backs off exponentially with jitter between attempts,
+# and keep-alive lets pooled connections be reused across uploads.
+CLIENT_CONFIG = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                       retries={'total_max_attempts': MAX_RETRIES,
+                                'mode': 'adaptive'},
+                       tcp_keepalive=True,
+                       s3={'addressing_style': 'virtual',
+                           'use_accelerate_endpoint': False})
+# Errors that mark an upload as failed instead of ending the run
+UPLOAD_ERRORS = (boto3.exceptions.S3UploadFailedError, BotoCoreError,
+                 ClientError, OSError, tarfile.TarError)
+# Progress is reported in steps of this fraction of the file size. All
+# uploads share one lock so their lines do not interleave on stdout.
+PROGRESS_STEP = 0.1
+PROGRESS_LOCK = threading.Lock()
+LOG_HEADER = ['Filename', 'Source', 'Destination', 'Status', 'Start Time',
+              'End Time', 'Duration', 'File Size', 'Validated']
+
+@dataclass(slots=True)
+class UploadRecord:
+    """
+    The details of a single file upload, as shown in the summary and log.
+    """
+    filename: str
+    source: str
+    destination: str
+    status: str
+    start: str
+    end: str
+    duration: float
+    size: int
+    validated: str
 
-def main():
+def parse_args(argv=None):
+    """
+    Parses the command-line arguments, defaulting to the predefined folder
+    and S3 bucket/prefix.
+    """
+    parser = argparse.ArgumentParser(
+        description="Upload files from a local folder to an S3 bucket.")
+    parser.add_argument('--bucket', default=S3_BUCKET_NAME,
+                        help="S3 bucket name (default: %(default)s)")
+    parser.add_argument('--prefix', default=S3_PREFIX,
+                        help="S3 key prefix (default: %(default)s)")
+    parser.add_argument('--folder', default=FOLDER_PATH,
+                        help="Source directory (default: %(default)s)")
+    parser.add_argument('--bundle', action='store_true',
+                        default=BUNDLE_SMALL_FILES,
+                        help="Upload files smaller than "
+                             f"{BUNDLE_THRESHOLD_BYTES} bytes together as "
+                             "a single tar.gz archive")
+    parser.add_argument('--yes', '-y', action='store_true',
+                        help="Skip the confirmation prompts")
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """
     The main function that handles the file upload process.
     """
+    args = parse_args(argv)
+
+    # Resolve credentials before uploading so the first upload does not pay
+    # for the lookup (such as an instance metadata request on EC2)
+    session = boto3.session.Session()
+    credentials = session.get_credentials()
+    if credentials is None:
+        print("No AWS credentials found. Please configure your credentials.")
+        sys.exit(1)
+    credentials.get_frozen_credentials()
+
     # Create the S3 client
-    s3 = boto3.client('s3')
+    s3 = session.client('s3', config=CLIENT_CONFIG)
 
     # Confirm the S3 bucket name and prefix
-    confirm_s3_details(S3_BUCKET_NAME, S3_PREFIX)
+    confirm_s3_details(args.bucket, args.prefix, args.yes)
 
     # Confirm the source directory
-    confirm_source_dir(FOLDER_PATH)
+    confirm_source_dir(args.folder, args.yes)
 
     # Upload files from the folder to the S3 bucket, creating a new log file
-    # for each upload
+    # for the run
     uploaded_files, failed_files, log_file_path = upload_files_to_s3(
-        FOLDER_PATH, S3_BUCKET_NAME, S3_PREFIX, s3)
-
-    if uploaded_files:
-        print("Successful file transfers:")
-        for filename, source, destination, status, start_time, end_time, \
-                duration, file_size, validated in uploaded_files:
-            if not filename.startswith('.'):
-                print(f"Filename:\t{filename}")
-                print(f"Source:\t\t{source}")
-                print(f"Destination:\t{destination}")
-                print(f"Status:\t\t{status}")
-                print(f"Start Time:\t{start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"End Time:\t{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"Duration:\t{duration:.1f} seconds")
-                print(f"File Size:\t{file_size}")
-                print(f"Validated:\t{validated}")
-                print()
-
-    if failed_files:
-        print("Failed file transfers:")
-        for filename, source, destination, status, start_time, end_time, \
-                duration, file_size, validated in failed_files:
-            if not filename.startswith('.'):
-                print(f"Filename:\t{filename}")
-                print(f"Source:\t\t{source}")
-                print(f"Destination:\t{destination}")
-                print(f"Status:\t\t{status}")
-                print(f"Start Time:\t{start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"End Time:\t{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"Duration:\t{duration:.1f} seconds")
-                print(f"File Size:\t{file_size}")
-                print(f"Validated:\t{validated}")
-                print()
-
-    print(f"Transfer summary: Uploaded "
-          f"{len([f for f in uploaded_files if not f[0].startswith('.')])} files, "
-          f"Failed {len([f for f in failed_files if not f[0].startswith('.')])} files, "
-          f"Log file saved as {log_file_path}")
-
-def confirm_s3_details(s3_bucket_name, s3_prefix):
+        args.folder, args.bucket, args.prefix, s3, args.bundle)
+
+    # Build the whole report in memory so it is written with a single call
+    report = io.StringIO()
+    for title, records in (("Successful file transfers:", uploaded_files),
+                           ("Failed file transfers:", failed_files)):
+        if records:
+            report.write(f"{title}\n")
+            for r in records:
+                report.write(f"Filename:\t{r.filename}\n"
+                             f"Source:\t\t{r.source}\n"
+                             f"Destination:\t{r.destination}\n"
+                             f"Status:\t\t{r.status}\n"
+                             f"Start Time:\t{r.start}\n"
+                             f"End Time:\t{r.end}\n"
+                             f"Duration:\t{r.duration:.1f} seconds\n"
+                             f"File Size:\t{r.size}\n"
+                             f"Validated:\t{r.validated}\n\n")
+
+    report.write(f"Transfer summary: Uploaded "
+                 f"{len(uploaded_files)} files, "
+                 f"Failed {len(failed_files)} files, "
+                 f"Log file saved as {log_file_path}\n")
+    sys.stdout.write(report.getvalue())
+
+def confirm_s3_details(s3_bucket_name, s3_prefix, assume_yes=False):
     """
     Confirms the S3 bucket name and prefix.
     """
     print(f"S3 bucket name: {s3_bucket_name}")
     print(f"S3 prefix: {s3_prefix}")
+    if assume_yes:
+        return
     confirmation = input("Is this information correct? (y/n) ")
     if confirmation.lower() != "y":
-        print("Please update the script with the correct S3 bucket name "
-              "and prefix.")
-        exit(1)
+        print("Please pass the correct S3 bucket name and prefix with "
+              "--bucket and --prefix, or update the script.")
+        sys.exit(1)
 
-def confirm_source_dir(folder_path):
+def confirm_source_dir(folder_path, assume_yes=False):
     """
     Confirms the source directory.
     """
     print(f"Source directory: {folder_path}")
+    if assume_yes:
+        return
     confirmation = input("Is this information correct? (y/n) ")
     if confirmation.lower() != "y":
-        print("Please update the script with the correct source directory.")
-        exit(1)
+        print("Please pass the correct source directory with --folder, "
+              "or update the script.")
+        sys.exit(1)
 
-def upload_files_to_s3(folder_path, s3_bucket_name, s3_prefix, s3):
+def upload_files_to_s3(folder_path, s3_bucket_name, s3_prefix, s3,
+                       bundle_small_files=BUNDLE_SMALL_FILES):
     """
-    Uploads files from the folder to the S3 bucket, creating a new log file
-    for each upload.
+    Uploads files from the folder to the S3 bucket, recording every upload
+    in a new log file. Files below the bundle threshold are uploaded as one
+    archive when bundle_small_files is set.
     """
     logs_dir = os.path.join(folder_path, "logs")
     try:
         os.makedirs(logs_dir, exist_ok=True)
     except OSError as e:
-        if e.errno != 17:  # Ignore "File exists" error
-            print(f"Error creating logs directory: {e}")
-            return
+        print(f"Error creating logs directory: {e}")
+        return [], [], None
 
+    run_stamp = datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+    log_file_path = os.path.join(logs_dir, f"log_{run_stamp}.csv")
+    jobs = plan_uploads(s3, list_source_files(folder_path), s3_bucket_name,
+                        s3_prefix, run_stamp, bundle_small_files)
+    with UploadLog(log_file_path) as log:
+        uploaded_files, failed_files = run_uploads(jobs, log)
+    return uploaded_files, failed_files, log_file_path
+
+def plan_uploads(s3, files, s3_bucket_name, s3_prefix, run_stamp,
+                 bundle_small_files):
+    """
+    Turns the (entry, size) pairs into upload jobs. Each job is a tuple of
+    the upload function, the files it covers, the destination URI and the
+    file size (None for a bundle).
+    """
+    jobs = []
+    if bundle_small_files:
+        bundle = [(entry, file_size) for entry, file_size in files
+                  if file_size < BUNDLE_THRESHOLD_BYTES]
+        files = [(entry, file_size) for entry, file_size in files
+                 if file_size >= BUNDLE_THRESHOLD_BYTES]
+        if bundle:
+            s3_key = f"{s3_prefix}/bundle_{run_stamp}.tar.gz"
+            print(f"Bundling {len(bundle)} files into {s3_key}")
+            jobs.append((partial(upload_bundle, s3,
+                                 [entry for entry, _ in bundle],
+                                 s3_bucket_name, s3_key),
+                         bundle, f"s3://{s3_bucket_name}/{s3_key}", None))
+    for entry, file_size in files:
+        s3_key = f"{s3_prefix}/{entry.name}"
+        jobs.append((partial(upload_file_entry, s3, entry, file_size,
+                             s3_bucket_name, s3_key),
+                     [(entry, file_size)], f"s3://{s3_bucket_name}/{s3_key}",
+                     file_size))
+    return jobs
+
+def run_uploads(jobs, log):
+    """
+    Runs the upload jobs concurrently. Returns the records of the
+    successful and of the failed uploads.
+    """
     uploaded_files = []
     failed_files = []
-    log_file_path = None
-
-    for filename in os.listdir(folder_path):
-        if not filename.startswith('.') and filename != 'logs':
-            file_path = os.path.join(folder_path, filename)
-            s3_key = f"{s3_prefix}/{filename}"
-            log_file = os.path.join(logs_dir, f"log_"
-                f"{datetime.now().strftime('%Y-%m-dT%H-%M-%S')}.csv")
-            retries = 0
-            while retries < MAX_RETRIES:
-                try:
-                    start_time = datetime.now()
-                    with open(file_path, 'rb') as file:
-                        s3.upload_fileobj(file, s3_bucket_name, s3_key,
-                                         Callback=ProgressPercentage(file,
-                                                                    filename,
-                                                                    s3_bucket_name,
-                                                                    s3_key))
-                    end_time = datetime.now()
-                    duration = (end_time - start_time).total_seconds()
-                    file_size = os.path.getsize(file_path)
-                    validated = validate_file_upload(s3, s3_bucket_name, s3_key,
-                                                    file_size)
-                    log_file_path = write_to_log(log_file, filename, file_path,
-                                                f"s3://{s3_bucket_name}/{s3_key}",
-                                                'Uploaded', start_time, end_time,
-                                                duration, file_size, validated)
-                    uploaded_files.append((filename, file_path,
-                                         f"s3://{s3_bucket_name}/{s3_key}",
-                                         'Uploaded', start_time, end_time,
-                                         duration, file_size, validated))
-                    break  # Exit the retry loop if the upload is successful
-                except boto3.exceptions.S3UploadFailedError as e:
-                    end_time = datetime.now()
-                    duration = (end_time - start_time).total_seconds()
-                    file_size = os.path.getsize(file_path)
-                    log_file_path = write_to_log(log_file, filename, file_path,
-                                                f"s3://{s3_bucket_name}/{s3_key}",
-                                                'Failed', start_time, end_time,
-                                                duration, file_size, 'No')
-                    failed_files.append((filename, file_path,
-                                        f"s3://{s3_bucket_name}/{s3_key}",
-                                        'Failed', start_time, end_time,
-                                        duration, file_size, 'No'))
-                    print(f"Error uploading {filename}: {e}")
-                    retries += 1
-                    if retries < MAX_RETRIES:
-                        print(f"Retrying upload for {filename} ({retries}/{MAX_RETRIES})")
-                        time.sleep(5)  # Wait for 5 seconds before retrying
-                    else:
-                        print(f"Maximum retries reached for {filename}. "
-                              "Skipping file.")
-    return uploaded_files, failed_files, log_file_path
+    budget = ByteBudget(MAX_INFLIGHT_BYTES)
+    with ThreadPoolExecutor(max_workers=MAX_SMALL_FILE_WORKERS) \
+            as small_executor, \
+            ThreadPoolExecutor(max_workers=MAX_LARGE_FILE_WORKERS) \
+            as large_executor:
+        futures = []
+        for upload, files, destination, file_size in jobs:
+            if file_size is not None \
+                    and file_size < TRANSFER_CONFIG.multipart_threshold:
+                executor = small_executor
+            else:
+                executor = large_executor
+            futures.append(executor.submit(
+                record_upload, upload, files, destination, log, budget,
+                upload_memory_cost(file_size)))
+        for future in as_completed(futures):
+            records, succeeded = future.result()
+            if succeeded:
+                uploaded_files.extend(records)
+            else:
+                failed_files.extend(records)
+    return uploaded_files, failed_files
 
-def write_to_log(log_file, filename, source, destination, status, start_time,
-                 end_time, duration, file_size, validated):
+def record_upload(upload, files, destination, log, budget, memory_cost):
     """
-    Writes the file upload details to a log file.
+    Runs an upload within the memory budget and logs its outcome for each
+    of the files it covers. Returns the upload records and whether the
+    upload succeeded.
     """
-    header = ['Filename', 'Source', 'Destination', 'Status', 'Start Time',
-              'End Time', 'Duration', 'File Size', 'Validated']
-    rows = [[filename, source, destination, status,
-             start_time.strftime('%Y-%m-%d %H:%M:%S'),
-             end_time.strftime('%Y-%m-%d %H:%M:%S'),
-             duration, file_size, validated]]
+    # Memory is reserved only once a worker starts the upload, so queued
+    # uploads do not hold budget they are not using
+    cost = budget.acquire(memory_cost)
+    start_time = datetime.now()
+    try:
+        validated = upload()
+        status = 'Uploaded'
+    except UPLOAD_ERRORS as e:
+        print(f"Error uploading {destination}: {e}")
+        validated = 'No'
+        status = 'Failed'
+    finally:
+        budget.release(cost)
+    end_time = datetime.now()
+    duration = (end_time - start_time).total_seconds()
+    start = start_time.isoformat(sep=' ', timespec='seconds')
+    end = end_time.isoformat(sep=' ', timespec='seconds')
+    records = [UploadRecord(entry.name, entry.path, destination, status,
+                            start, end, duration, file_size, validated)
+               for entry, file_size in files]
+    log.write(records)
+    return records, status == 'Uploaded'
 
-    if not os.path.exists(log_file):
-        with open(log_file, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            writer.writerows(rows)
-    else:
-        with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerows(rows)
+def upload_file_entry(s3, entry, file_size, s3_bucket_name, s3_key):
+    """
+    Uploads a single file and returns whether the upload was validated.
+    """
+    progress = make_progress(file_size, entry.name)
+    if file_size < TRANSFER_CONFIG.multipart_threshold:
+        # Single-part uploads are validated from the PutObject response,
+        # saving a HeadObject round trip
+        validated = put_small_file(s3, entry.path, s3_bucket_name, s3_key)
+        if progress:
+            progress(file_size)
+        return validated
+    # Passing the path lets the transfer manager read parts from several
+    # offsets of the file in parallel
+    s3.upload_file(entry.path, s3_bucket_name, s3_key,
+                   Config=TRANSFER_CONFIG, Callback=progress)
+    return validate_file_upload(s3, s3_bucket_name, s3_key,
+                                file_size=file_size)
 
-    return log_file
+def list_source_files(folder_path):
+    """
+    Lists the files to upload from the folder together with their sizes,
+    skipping hidden files, the logs directory and entries that cannot be
+    read.
+    """
+    files = []
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.name.startswith('.') or entry.name == 'logs':
+                continue
+            try:
+                if entry.is_file():
+                    files.append((entry, entry.stat().st_size))
+            except OSError as e:
+                print(f"Skipping {entry.name}: {e}")
+    return files
+
+def upload_memory_cost(file_size):
+    """
+    Estimates the memory an upload holds while in flight. Single-part
+    uploads are read fully into memory, while multipart and streamed
+    uploads (file_size None) buffer at most one chunk per concurrent part.
+    """
+    max_buffered = (TRANSFER_CONFIG.multipart_chunksize
+                    * TRANSFER_CONFIG.max_concurrency)
+    if file_size is None:
+        return max_buffered
+    return min(file_size, max_buffered)
 
-def validate_file_upload(s3, s3_bucket_name, s3_key, file_size):
+class UploadLog(object):
     """
-    Validates the file upload by checking the content length.
+    A class to write upload records to a CSV log file. The file is opened
+    once for the whole batch and shared by the upload threads.
+    """
+    def __init__(self, log_file_path):
+        self._csvfile = open(log_file_path, 'w', newline='',
+                             buffering=1 << 16, encoding='utf-8')
+        self._writer = csv.writer(self._csvfile)
+        self._writer.writerow(LOG_HEADER)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._csvfile.close()
+
+    def write(self, records):
+        """
+        Writes the file upload details to the log file.
+        """
+        with self._lock:
+            self._writer.writerows(
+                [r.filename, r.source, r.destination, r.status, r.start,
+                 r.end, r.duration, r.size, r.validated]
+                for r in records)
+
+def put_small_file(s3, file_path, s3_bucket_name, s3_key):
+    """
+    Uploads a file in a single PutObject request and validates it by
+    comparing the returned ETag with the MD5 of the local file.
+    """
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    response = s3.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=data)
+    if response['ETag'].strip('"') == hashlib.md5(
+            data, usedforsecurity=False).hexdigest():
+        return 'Yes'
+    return 'No'
+
+def upload_bundle(s3, entries, s3_bucket_name, s3_key):
+    """
+    Streams files into a gzipped tar archive that is uploaded as a single
+    object, without writing the archive to disk. Returns whether the
+    uploaded archive was validated.
+    """
+    read_fd, write_fd = os.pipe()
+    feed_errors = []
+
+    def _feed():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_out, \
+                    tarfile.open(fileobj=pipe_out, mode='w|gz') as tar:
+                for entry in entries:
+                    tar.add(entry.path, arcname=entry.name)
+        except BrokenPipeError:
+            pass  # The upload stopped reading and reports its own error
+        except Exception as e:  # Re-raised in the uploading thread
+            feed_errors.append(e)
+
+    feeder = threading.Thread(target=_feed, daemon=True)
+    feeder.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe_in:
+            hashing_file = HashingFile(pipe_in, TRANSFER_CONFIG)
+            s3.upload_fileobj(hashing_file, s3_bucket_name, s3_key,
+                              Config=TRANSFER_CONFIG)
+    finally:
+        feeder.join()
+    if feed_errors:
+        # The upload finished on a truncated archive; remove it so no corrupt
+        # bundle is left in the bucket
+        try:
+            s3.delete_object(Bucket=s3_bucket_name, Key=s3_key)
+        except (BotoCoreError, ClientError) as e:
+            print(f"Error deleting incomplete bundle {s3_key}: {e}")
+        raise feed_errors[0]
+    return validate_file_upload(s3, s3_bucket_name, s3_key,
+                                etag=hashing_file.etag())
+
+def validate_file_upload(s3, s3_bucket_name, s3_key, etag=None,
+                         file_size=None):
+    """
+    Validates an upload with a HeadObject request, comparing the object's
+    ETag and/or content length with the given values.
     """
     try:
         obj = s3.head_object(Bucket=s3_bucket_name, Key=s3_key)
-        if obj['ContentLength'] == file_size:
-            return 'Yes'
-        else:
+        if etag is not None and obj['ETag'].strip('"') != etag:
+            return 'No'
+        if file_size is not None and obj['ContentLength'] != file_size:
             return 'No'
-    except boto3.exceptions.S3UploadFailedError as e:
+        return 'Yes'
+    except (BotoCoreError, ClientError) as e:
         print(f"Error validating {s3_key}: {e}")
         return 'No'
 
-class ProgressPercentage(object):
+class HashingFile(object):
     """
-    A class to display the progress of file uploads.
+    A read-only file wrapper that computes the ETag S3 will assign to the
+    data as it is read. Used for the streamed bundle archive, which exists
+    only in the pipe and cannot be re-read to validate the upload.
     """
-    def __init__(self, file_obj, filename, s3_bucket_name, s3_key):
-        self._filename = filename
+    def __init__(self, file_obj, transfer_config):
         self._file_obj = file_obj
-        self._size = float(os.fstat(file_obj.fileno()).st_size)
-        self._seen_so_far = 0
-        self._s3_bucket_name = s3_bucket_name
-        self._s3_key = s3_key
-
-    def __call__(self, bytes_amount):
-        self._seen_so_far += bytes_amount
-        percentage = (self._seen_so_far / self._size) * 100
-        sys.stdout.write(
-            f"\r{self._filename} {self._seen_so_far} / {self._size} ({percentage:.2f}%)")
-        sys.stdout.flush()
+        self._multipart_threshold = transfer_config.multipart_threshold
+        self._part_size = transfer_config.multipart_chunksize
+        self._part_remaining = self._part_size
+        self._size = 0
+        self._part_hash = hashlib.md5(usedforsecurity=False)
+        self._part_digests = []
+
+    def read(self, amount=-1):
+        data = self._file_obj.read(amount)
+        self._size += len(data)
+        view = memoryview(data)
+        while view:
+            chunk = view[:self._part_remaining]
+            self._part_hash.update(chunk)
+            self._part_remaining -= len(chunk)
+            view = view[len(chunk):]
+            if not self._part_remaining:
+                self._part_digests.append(self._part_hash.digest())
+                self._part_hash = hashlib.md5(usedforsecurity=False)
+                self._part_remaining = self._part_size
+        return data
+
+    def etag(self):
+        """
+        Returns the ETag S3 assigns to an upload of the data read.
+        """
+        digests = list(self._part_digests)
+        if self._part_remaining != self._part_size:
+            digests.append(self._part_hash.digest())
+        if self._size < self._multipart_threshold and len(digests) <= 1:
+            # Sent as a single PutObject, whose ETag is the plain MD5
+            return digests[0].hex() if digests else self._part_hash.hexdigest()
+        combined = hashlib.md5(b''.join(digests), usedforsecurity=False)
+        return f"{combined.hexdigest()}-{len(digests)}"
+
+class ByteBudget(object):
+    """
+    A class to limit the number of bytes held by in-flight uploads.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._inflight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount):
+        """
+        Blocks until the amount fits in the budget, then reserves it. The
+        amount is capped at the budget so an upload larger than the budget
+        can still run on its own. Returns the amount reserved.
+        """
+        amount = min(amount, self._max_bytes)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._inflight + amount <= self._max_bytes)
+            self._inflight += amount
+        return amount
+
+    def release(self, amount):
+        """
+        Returns a previously reserved amount to the budget.
+        """
+        with self._condition:
+            self._inflight -= amount
+            self._condition.notify_all()
+
+def make_progress(file_size, filename):
+    """
+    Returns a callback that displays the progress of a file upload, or None
+    when stdout is not a terminal and the progress would not be seen.
+    Uploads run concurrently, so each update is printed as its own line
+    under a lock shared by all uploads.
+    """
+    if not sys.stdout.isatty():
+        return None
+    size = float(file_size)
+    inv_size = 100.0 / size if size else 0.0
+    step = size * PROGRESS_STEP
+    seen_so_far = 0
+    last_emit = 0
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+
+    def progress(bytes_amount):
+        nonlocal seen_so_far, last_emit
+        with PROGRESS_LOCK:
+            seen_so_far += bytes_amount
+            done = seen_so_far >= size
+            if not done and seen_so_far - last_emit <= step:
+                return
+            last_emit = seen_so_far
+            write(f"{filename} {seen_so_far} / {size} "
+                  f"({seen_so_far * inv_size:.2f}%)\n")
+            flush()
+
+    return progress
 
 if __name__ == "__main__":
     main()
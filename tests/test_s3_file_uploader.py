@@ -0,0 +1,404 @@
+"""
+Tests for s3_file_uploader.
+"""
+
+import contextlib
+import csv
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_aws
+
+# Allow running this file directly as well as through unittest discovery
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import s3_file_uploader  # noqa: E402
+from s3_file_uploader import (  # noqa: E402
+    ByteBudget, HashingFile, make_progress)
+
+BUCKET = 'test-bucket'
+PREFIX = 'incoming'
+
+PART_SIZE = 16
+CONFIG = TransferConfig(multipart_threshold=PART_SIZE,
+                        multipart_chunksize=PART_SIZE)
+
+
+def read_all(data, read_size, config=CONFIG):
+    """
+    Reads data through a HashingFile in read_size pieces and returns its
+    ETag.
+    """
+    hashing_file = HashingFile(io.BytesIO(data), config)
+    while hashing_file.read(read_size):
+        pass
+    return hashing_file.etag()
+
+
+def multipart_etag(data, part_size=PART_SIZE):
+    """
+    Returns the ETag S3 assigns to a multipart upload of data.
+    """
+    parts = [data[i:i + part_size] for i in range(0, len(data), part_size)]
+    digests = b''.join(hashlib.md5(part).digest() for part in parts)
+    return f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"
+
+
+class HashingFileTest(unittest.TestCase):
+
+    def test_below_threshold_is_plain_md5(self):
+        data = b'a' * (PART_SIZE - 1)
+        self.assertEqual(read_all(data, 5), hashlib.md5(data).hexdigest())
+
+    def test_empty_is_plain_md5(self):
+        self.assertEqual(read_all(b'', 5), hashlib.md5(b'').hexdigest())
+
+    def test_exactly_threshold_is_single_part_multipart(self):
+        data = bytes(range(PART_SIZE))
+        self.assertEqual(read_all(data, 5), multipart_etag(data))
+        self.assertTrue(read_all(data, 5).endswith('-1'))
+
+    def test_above_threshold_is_multipart(self):
+        data = bytes(range(PART_SIZE * 2 + 1))
+        self.assertEqual(read_all(data, 5), multipart_etag(data))
+        self.assertTrue(read_all(data, 5).endswith('-3'))
+
+    def test_read_size_does_not_change_etag(self):
+        data = bytes(range(200))
+        expected = multipart_etag(data)
+        for read_size in (1, 7, PART_SIZE, PART_SIZE + 1, -1):
+            self.assertEqual(read_all(data, read_size), expected)
+
+    def test_threshold_above_part_size(self):
+        config = TransferConfig(multipart_threshold=PART_SIZE * 4,
+                                multipart_chunksize=PART_SIZE)
+        data = b'b' * PART_SIZE
+        self.assertEqual(read_all(data, 3, config),
+                         hashlib.md5(data).hexdigest())
+
+    def test_read_returns_underlying_data(self):
+        hashing_file = HashingFile(io.BytesIO(b'abcdef'), CONFIG)
+        self.assertEqual(hashing_file.read(4), b'abcd')
+        self.assertEqual(hashing_file.read(), b'ef')
+        self.assertEqual(hashing_file.read(), b'')
+
+
+class S3TestCase(unittest.TestCase):
+    """
+    Runs each test against a mocked S3 bucket and a temporary source folder.
+    """
+
+    def setUp(self):
+        mocked = mock_aws()
+        mocked.start()
+        self.addCleanup(mocked.stop)
+        self.s3 = boto3.client('s3', region_name='us-east-1',
+                               config=s3_file_uploader.CLIENT_CONFIG)
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def write_file(self, name, data):
+        """
+        Creates a file in the source folder.
+        """
+        with open(os.path.join(self.folder, name), 'wb') as file:
+            file.write(data)
+
+    def upload(self, **kwargs):
+        """
+        Uploads the source folder and returns the results and the log rows.
+        """
+        with mock.patch('sys.stdout', io.StringIO()):
+            uploaded, failed, log_file_path = \
+                s3_file_uploader.upload_files_to_s3(
+                    self.folder, BUCKET, PREFIX, self.s3, **kwargs)
+        with open(log_file_path, newline='', encoding='utf-8') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        return uploaded, failed, rows
+
+
+class UploadFilesTest(S3TestCase):
+
+    def test_uploads_and_validates_files(self):
+        self.write_file('small.txt', b'hello')
+        self.write_file('large.bin', b'x' * (9 * 1024 * 1024))
+        self.write_file('.hidden', b'secret')
+        uploaded, failed, rows = self.upload()
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(r.filename for r in uploaded),
+                         ['large.bin', 'small.txt'])
+        self.assertEqual({r.validated for r in uploaded}, {'Yes'})
+        self.assertEqual(len(rows), 2)
+        obj = self.s3.get_object(Bucket=BUCKET, Key=f"{PREFIX}/small.txt")
+        self.assertEqual(obj['Body'].read(), b'hello')
+
+    def test_network_error_is_recorded_as_failed(self):
+        self.write_file('small.txt', b'hello')
+        error = EndpointConnectionError(endpoint_url='http://127.0.0.1:1')
+        with mock.patch.object(self.s3, 'put_object', side_effect=error):
+            uploaded, failed, rows = self.upload()
+        self.assertEqual(uploaded, [])
+        self.assertEqual([r.filename for r in failed], ['small.txt'])
+        self.assertEqual([row['Status'] for row in rows], ['Failed'])
+
+    def test_unreadable_file_is_recorded_as_failed(self):
+        self.write_file('small.txt', b'hello')
+        self.write_file('other.txt', b'world')
+        real_open = open
+
+        def _open(path, *args, **kwargs):
+            if str(path).endswith('small.txt'):
+                raise PermissionError(13, 'Permission denied', path)
+            return real_open(path, *args, **kwargs)
+
+        with mock.patch('builtins.open', _open):
+            uploaded, failed, rows = self.upload()
+        self.assertEqual([r.filename for r in uploaded], ['other.txt'])
+        self.assertEqual([r.filename for r in failed], ['small.txt'])
+        self.assertEqual(sorted(row['Status'] for row in rows),
+                         ['Failed', 'Uploaded'])
+
+
+class UploadBundleTest(S3TestCase):
+
+    def list_objects(self):
+        """
+        Returns the keys in the test bucket.
+        """
+        response = self.s3.list_objects_v2(Bucket=BUCKET)
+        return [obj['Key'] for obj in response.get('Contents', [])]
+
+    def test_small_files_are_bundled(self):
+        self.write_file('a.txt', b'aaa')
+        self.write_file('b.txt', b'bbb')
+        uploaded, failed, rows = self.upload(bundle_small_files=True)
+        self.assertEqual(failed, [])
+        self.assertEqual({r.validated for r in uploaded}, {'Yes'})
+        self.assertEqual(len(rows), 2)
+        [key] = self.list_objects()
+        self.assertTrue(key.startswith(f"{PREFIX}/bundle_"))
+        body = self.s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertEqual(sorted(tar.getnames()), ['a.txt', 'b.txt'])
+
+    def test_truncated_bundle_is_deleted(self):
+        self.write_file('a.txt', b'aaa')
+        self.write_file('b.txt', b'bbb')
+        real_list_source_files = s3_file_uploader.list_source_files
+
+        def _list_then_delete(folder_path):
+            files = real_list_source_files(folder_path)
+            os.remove(os.path.join(folder_path, 'b.txt'))
+            return files
+
+        with mock.patch.object(s3_file_uploader, 'list_source_files',
+                               _list_then_delete):
+            uploaded, failed, rows = self.upload(bundle_small_files=True)
+        self.assertEqual(uploaded, [])
+        self.assertEqual(sorted(r.filename for r in failed),
+                         ['a.txt', 'b.txt'])
+        self.assertEqual({row['Status'] for row in rows}, {'Failed'})
+        self.assertEqual(self.list_objects(), [])
+
+
+class ByteBudgetTest(unittest.TestCase):
+
+    def test_acquire_is_capped_at_budget(self):
+        budget = ByteBudget(100)
+        self.assertEqual(budget.acquire(250), 100)
+        budget.release(100)
+        self.assertEqual(budget.acquire(40), 40)
+
+    def test_acquire_blocks_until_release(self):
+        budget = ByteBudget(100)
+        budget.acquire(60)
+        acquired = threading.Event()
+
+        def _acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        waiter = threading.Thread(target=_acquire, daemon=True)
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(60)
+        self.assertTrue(acquired.wait(5))
+        waiter.join(5)
+
+
+class MemoryBudgetTest(S3TestCase):
+
+    def max_concurrent_uploads(self):
+        """
+        Uploads six 1000-byte files and returns how many were in flight at
+        the same time.
+        """
+        for i in range(6):
+            self.write_file(f"file{i}.txt", b'x' * 1000)
+        lock = threading.Lock()
+        counts = {'current': 0, 'max': 0}
+        real_put_small_file = s3_file_uploader.put_small_file
+
+        def _put_small_file(*args):
+            with lock:
+                counts['current'] += 1
+                counts['max'] = max(counts['max'], counts['current'])
+            time.sleep(0.05)
+            try:
+                return real_put_small_file(*args)
+            finally:
+                with lock:
+                    counts['current'] -= 1
+
+        with mock.patch.object(s3_file_uploader, 'put_small_file',
+                               _put_small_file):
+            uploaded, failed, _ = self.upload()
+        self.assertEqual((len(uploaded), failed), (6, []))
+        return counts['max']
+
+    def test_uploads_run_concurrently_within_default_budget(self):
+        self.assertGreater(self.max_concurrent_uploads(), 1)
+
+    def test_budget_gates_uploads(self):
+        with mock.patch.object(s3_file_uploader, 'MAX_INFLIGHT_BYTES', 1500):
+            self.assertEqual(self.max_concurrent_uploads(), 1)
+
+
+class FakeTerminal(io.StringIO):
+    """
+    A StringIO that reports itself as a terminal.
+    """
+    def isatty(self):
+        return True
+
+
+class MakeProgressTest(unittest.TestCase):
+
+    def test_no_callback_when_not_a_terminal(self):
+        with mock.patch('sys.stdout', io.StringIO()):
+            self.assertIsNone(make_progress(100, 'file.txt'))
+
+    def test_output_is_throttled_to_whole_lines(self):
+        terminal = FakeTerminal()
+        with mock.patch('sys.stdout', terminal):
+            progress = make_progress(1000, 'file.txt')
+            for _ in range(1000):
+                progress(1)
+        lines = terminal.getvalue().splitlines()
+        self.assertLessEqual(len(lines), 11)
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(all(line.startswith('file.txt ') for line in lines))
+        self.assertEqual(lines[-1], "file.txt 1000 / 1000.0 (100.00%)")
+
+    def test_completion_is_always_reported(self):
+        terminal = FakeTerminal()
+        with mock.patch('sys.stdout', terminal):
+            make_progress(1000, 'file.txt')(1000)
+        self.assertEqual(terminal.getvalue(),
+                         "file.txt 1000 / 1000.0 (100.00%)\n")
+
+    def test_concurrent_uploads_do_not_interleave(self):
+        terminal = FakeTerminal()
+        with mock.patch('sys.stdout', terminal):
+            callbacks = [make_progress(100, f"file{i}.txt") for i in range(8)]
+            threads = [threading.Thread(target=lambda cb=cb: [
+                cb(1) for _ in range(100)]) for cb in callbacks]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        for line in terminal.getvalue().splitlines():
+            self.assertRegex(line, r"^file\d\.txt \d+ / 100\.0 \(\d+\.\d\d%\)$")
+
+
+class ListSourceFilesTest(unittest.TestCase):
+
+    def test_skips_entries_that_vanish_before_stat(self):
+        class VanishedEntry:
+            name = 'gone.txt'
+            path = '/nowhere/gone.txt'
+
+            def is_file(self):
+                return True
+
+            def stat(self):
+                raise FileNotFoundError(2, 'No such file', self.path)
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        with open(os.path.join(folder, 'kept.txt'), 'wb') as file:
+            file.write(b'abc')
+        os.mkdir(os.path.join(folder, 'logs'))
+        real_scandir = os.scandir
+
+        def _scandir(path):
+            with real_scandir(path) as it:
+                entries = list(it) + [VanishedEntry()]
+            return contextlib.nullcontext(iter(entries))
+
+        with mock.patch('os.scandir', _scandir), \
+                mock.patch('sys.stdout', io.StringIO()):
+            files = s3_file_uploader.list_source_files(folder)
+        self.assertEqual([(entry.name, size) for entry, size in files],
+                         [('kept.txt', 3)])
+
+
+class CommandLineTest(S3TestCase):
+
+    def test_parse_args_defaults(self):
+        args = s3_file_uploader.parse_args([])
+        self.assertEqual((args.bucket, args.prefix, args.folder),
+                         (s3_file_uploader.S3_BUCKET_NAME,
+                          s3_file_uploader.S3_PREFIX,
+                          s3_file_uploader.FOLDER_PATH))
+        self.assertFalse(args.yes)
+        self.assertFalse(args.bundle)
+
+    def test_parse_args_overrides(self):
+        args = s3_file_uploader.parse_args(
+            ['--bucket', 'b', '--prefix', 'p', '--folder', '/data', '-y',
+             '--bundle'])
+        self.assertEqual((args.bucket, args.prefix, args.folder),
+                         ('b', 'p', '/data'))
+        self.assertTrue(args.yes)
+        self.assertTrue(args.bundle)
+
+    def test_declined_confirmation_exits(self):
+        with mock.patch('builtins.input', return_value='n'), \
+                mock.patch('sys.stdout', io.StringIO()), \
+                self.assertRaises(SystemExit) as raised:
+            s3_file_uploader.confirm_source_dir('/data')
+        self.assertEqual(raised.exception.code, 1)
+
+    def test_main_with_yes_runs_without_prompts(self):
+        self.write_file('small.txt', b'hello')
+        output = io.StringIO()
+        with mock.patch('builtins.input',
+                        side_effect=AssertionError("prompted")), \
+                mock.patch.dict(os.environ,
+                                {'AWS_DEFAULT_REGION': 'us-east-1'}), \
+                mock.patch('sys.stdout', output):
+            s3_file_uploader.main(['--yes', '--bucket', BUCKET,
+                                   '--prefix', PREFIX,
+                                   '--folder', self.folder])
+        self.assertIn("Transfer summary: Uploaded 1 files, Failed 0 files",
+                      output.getvalue())
+        obj = self.s3.get_object(Bucket=BUCKET, Key=f"{PREFIX}/small.txt")
+        self.assertEqual(obj['Body'].read(), b'hello')
+
+
+if __name__ == "__main__":
+    unittest.main()